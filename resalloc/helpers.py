@@ -23,6 +23,9 @@ import threading
 import datetime
 from contextlib import contextmanager
 
+# Prefer the libyaml based loader, if available.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 class StateSetException(Exception):
     def __init__(self, message):
         self.message = message
@@ -92,7 +95,7 @@ def load_config_file(path):
         return {}
 
     with open(path, 'r') as fd:
-        config = yaml.safe_load(fd)
+        config = yaml.load(fd, Loader=YAML_LOADER)
         if not config:
             config = {}
         if not type(config) == dict:
@@ -100,22 +103,18 @@ def load_config_file(path):
         return config
 
 
-def careful_string_format(pattern, fill_dict):
-    result = None
+class _KeepMissingDict(dict):
+    """ Keep the unknown {placeholders} untouched by str.format_map() """
+    def __missing__(self, key):
+        return '{' + key + '}'
+
 
+def careful_string_format(pattern, fill_dict):
     fill_dict['datetime'] = datetime.datetime.now().isoformat()\
                                     .replace('-', '').replace('T', '_')\
                                     .replace(':', '')[:-7]
 
-    while True:
-        try:
-            result = pattern.format(**fill_dict)
-        except KeyError as e:
-            key = e.args[0]
-            fill_dict[key] = '{key}'.format(key=key)
-        break
-
-    return result
+    return pattern.format_map(_KeepMissingDict(fill_dict))
 
 
 @contextmanager
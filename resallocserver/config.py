@@ -37,7 +37,8 @@ def get_config():
         'port': 49100,
         'loglevel': 'info',
         # Maximum number of seconds Manager threads wait in loop.  Used for tests
-        # only ATM.  Watcher sleeps sleeptime/2.
+        # only ATM.  Watcher sleeps till the next livecheck is due (at most the
+        # shortest livecheck_period, 600s when no pool has cmd_livecheck).
         'sleeptime': 20,
     }
     config["config_dir"] = config_dir
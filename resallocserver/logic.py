@@ -39,13 +39,6 @@ def assign_ticket(resource, ticket):
     return resource.sandbox == ticket.sandbox
 
 
-def release_resource(ticket):
-    resource = ticket.resource
-    resource.ticket_id = None
-    resource.released_at = time.time()
-    resource.releases_counter += 1
-
-
 class QObject(object):
     session = None
 
@@ -82,6 +75,48 @@ class QResources(QObject):
         return (self.up()
                     .filter(models.Resource.ticket_id.isnot(None)))
 
+    def closed_tickets(self):
+        """
+        Get (id, name, id_in_pool, data) tuples of the _taken_ resources whose
+        ticket was already closed.
+        """
+        return (self.taken()
+                    .join(models.Ticket,
+                          models.Resource.ticket_id == models.Ticket.id)
+                    .outerjoin(models.IDWithinPool,
+                               models.IDWithinPool.resource_id ==
+                               models.Resource.id)
+                    .filter(models.Ticket.state == TState.CLOSED)
+                    .with_entities(models.Resource.id,
+                                   models.Resource.name,
+                                   models.IDWithinPool.id,
+                                   models.Resource.data))
+
+    def release(self, resource_ids, state=None):
+        """
+        Decouple the RESOURCE_IDS from their tickets (using one UPDATE
+        statement), and optionally switch the resources to STATE.
+        """
+        values = {
+            'ticket_id': None,
+            'released_at': time.time(),
+            'releases_counter': models.Resource.releases_counter + 1,
+        }
+        if state:
+            values['state'] = state
+        self.query.filter(models.Resource.id.in_(resource_ids))\
+                  .update(values, synchronize_session=False)
+
+    def request_removal(self, resource_ids):
+        """
+        Switch the (still UP and not taken) RESOURCE_IDS to DELETE_REQUEST
+        state, using one UPDATE statement.
+        """
+        (self.up().filter(models.Resource.ticket_id.is_(None))
+                  .filter(models.Resource.id.in_(resource_ids))
+                  .update({'state': RState.DELETE_REQUEST},
+                          synchronize_session=False))
+
     def starting(self):
         return self.query.filter_by(state=RState.STARTING)
 
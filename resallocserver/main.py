@@ -57,8 +57,9 @@ class AtomicEvent(object):
     any of the notify() actions, the whole time-period of manager's loop would
     have to be in critical section (too long).
     """
-    event = threading.Event()
-    cond = threading.Condition()
+    def __init__(self):
+        self.event = threading.Event()
+        self.cond = threading.Condition()
 
     def set(self):
         with self.cond:
@@ -80,6 +81,8 @@ class AtomicEvent(object):
 
 class Synchronizer(object):
     ticket = AtomicEvent()
+    # Wake-up the Watcher thread (e.g. when a new resource is allocated).
+    watcher = AtomicEvent()
     resource_ready = threading.Condition()
     resource_tid = None
 
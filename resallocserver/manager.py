@@ -17,30 +17,53 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import base64
-import os
+import contextlib
 import errno
+import os
+import functools
+import logging
+import selectors
+import shlex
+import shutil
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import warnings
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased, selectinload
 from resalloc import helpers
 from resalloc.helpers import RState
 from resallocserver import models
 from resallocserver.app import session_scope, app
 from resallocserver.logic import (
-        QResources, QTickets, assign_ticket, release_resource
+        QResources, QTickets, assign_ticket
 )
 from resallocserver.priority_queue import PriorityQueue, PriorityQueueTask
 
 
 REUSED_RESOURCE_PRIORITY = 500
 
+# Maximum number of Pool.loop() calls executed concurrently by Manager.
+MAX_PARALLEL_POOL_LOOPS = 32
+
+
+@functools.lru_cache(maxsize=None)
+def _base_env():
+    """
+    Snapshot of os.environ, taken when the first hook is executed (after the
+    server initialization is done).  Copying os.environ for each hook is
+    surprisingly expensive.
+    """
+    return dict(os.environ)
+
 
 def command_env(pool_id=None, res_id=None, res_name=None,
                 id_in_pool=None, data=None):
     pfx = 'RESALLOC_'
-    env = os.environ.copy()
+    env = dict(_base_env())
     env[pfx + 'ID'] = str(res_id)
     env[pfx + 'NAME'] = str(res_name)
     env[pfx + 'POOL_ID'] = str(pool_id)
@@ -50,70 +73,222 @@ def command_env(pool_id=None, res_id=None, res_name=None,
     return env
 
 
-def run_command(pool_id, res_id, res_name, id_in_pool, command, ltype='alloc',
-                catch_stdout_bytes=None, data=None,
-                catch_stdout_lines_securely=False):
-    app.log.debug("running: " + command)
-    env = command_env(pool_id, res_id, res_name, id_in_pool, data)
-    config = app.config
+def _stdout_chunks(process, logfile):
+    """
+    Iterate over the data chunks (as read by one read() call) printed by
+    PROCESS to its stdout PIPE, and copy the output to LOGFILE (if not None,
+    flushed once per batch of data read).  When
+    os.pidfd_open() is available (Linux 5.3+), we stop reading right after the
+    process exits, even though some of its (daemonized) children still keep
+    the pipe open.  Otherwise we read till EOF.
+    """
+    fd = process.stdout.fileno()
+    os.set_blocking(fd, False)
 
-    ldir = os.path.join(config['logdir'], 'hooks')
     try:
-        os.mkdir(ldir)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
 
-    lfile = os.path.join(ldir, '{0:06d}_{1}'.format(res_id, ltype))
-    with open(lfile, 'a+b') as logfile:
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ)
 
-        if not catch_stdout_bytes:
-            return {'status': subprocess.call(command, env=env, shell=True,
-                                              stdout=logfile, stderr=logfile)}
+    try:
+        while True:
+            events = selector.select()
+            exited = any(key.fd == pidfd for key, _ in events)
 
-        stdout_written = 0
-        stdout_stopped = False
+            # Drain everything that is available in the pipe.
+            while True:
+                try:
+                    chunk = os.read(fd, 65536)
+                except BlockingIOError:
+                    chunk = None
+                if not chunk:
+                    break
+                if logfile:
+                    logfile.write(chunk)
+                yield chunk
+
+            if logfile:
+                logfile.flush()
+            if chunk == b"" or exited:
+                break
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
 
-        # Run the sub-command to be captured.
-        sp = subprocess.Popen(command, env=env, shell=True,
-                              stdout=subprocess.PIPE, stderr=logfile)
 
-        captured_string = b""
+# Commands containing any of these need to be interpreted by shell.
+SHELL_SPECIAL_CHARS = frozenset("|&;<>()$`\\*?[]{}#~\n")
 
 
-        for line in iter(sp.stdout.readline, b''):
-            # Write to the log.
-            logfile.write(line)
-            logfile.flush()
+@functools.lru_cache(maxsize=256)
+def _shell_free_argv(command):
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if not argv or "=" in argv[0] or not shutil.which(argv[0]):
+        # variable assignment, shell keyword or builtin, or the executable
+        # doesn't exist (let the shell report the problem)
+        return None
+    return tuple(argv)
 
-            if stdout_stopped:
-                continue
 
-            if stdout_written + len(line) > catch_stdout_bytes:
-                if stdout_written == 0 and not catch_stdout_lines_securely:
-                    # Even the first line is too long for this buffer.  Catch at
-                    # least part of it.
-                    line = line[:catch_stdout_bytes]
-                    captured_string += line
+def command_argv(command):
+    """
+    Return the argv list for executing (shell) COMMAND directly (without the
+    intermediate /bin/sh process), or None when COMMAND needs the shell.
+    """
+    if SHELL_SPECIAL_CHARS.intersection(command):
+        return None
+    argv = _shell_free_argv(command)
+    return list(argv) if argv else None
 
-                stdout_stopped = True
-                if not catch_stdout_lines_securely:
-                    captured_string += b"<< trimmed >>\n"
-                continue
 
-            stdout_written += len(line)
-            captured_string += line
+def _spawn_command(command, **kwargs):
+    argv = command_argv(command)
+    if argv is not None:
+        try:
+            return subprocess.Popen(argv, **kwargs)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                raise
+            # E.g. ENOEXEC for scripts without the #! line, shell executes
+            # such scripts itself.
+    return subprocess.Popen(command, shell=True, **kwargs)
+
+
+def _capture_lines(chunks, catch_bytes, securely=False):
+    """
+    Capture the whole lines from the CHUNKS of data, at most CATCH_BYTES.  When
+    the first line is too long, its beginning is captured (unless SECURELY).
+    The trimmed output is marked by "<< trimmed >>" line (unless SECURELY).
+    The rest of the CHUNKS is consumed, but not processed.
+    """
+    chunks = iter(chunks)
+    # bytearray grows in place, no quadratic re-allocation as with bytes
+    captured = bytearray()
+    pending = bytearray()
+
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b"\n", start) + 1
+            line_end = end or len(pending)
+            if len(captured) + line_end - start > catch_bytes:
+                # This line (even though not yet complete) doesn't fit.
+                if not securely:
+                    if not captured:
+                        # Even the first line is too long for this buffer.
+                        # Catch at least part of it.
+                        captured += pending[start:start + catch_bytes]
+                    captured += b"<< trimmed >>\n"
+                for _ in chunks:
+                    pass
+                return bytes(captured)
+
+            if not end:
+                break
+            captured += pending[start:end]
+            start = end
+
+        del pending[:start]
+
+    # the last line without newline
+    captured += pending
+    return bytes(captured)
+
 
+@functools.lru_cache(maxsize=None)
+def _hooks_logdir(logdir):
+    """ Create the hooks/ log sub-directory (once), and return its path """
+    ldir = os.path.join(logdir, 'hooks')
+    os.makedirs(ldir, exist_ok=True)
+    return ldir
+
+
+@contextlib.contextmanager
+def _no_logfile():
+    """ No-op replacement for contextlib.nullcontext(), for Python 3.6 """
+    yield None
+
+
+def run_command(pool_id, res_id, res_name, id_in_pool, command, ltype='alloc',
+                catch_stdout_bytes=None, data=None,
+                catch_stdout_lines_securely=False, log=True):
+    """
+    Execute the hook COMMAND.  The hook output is appended to the
+    '<logdir>/hooks/<res_id>_<ltype>' file, unless LOG is False (then the
+    output is discarded).
+    """
+    app.log.debug("running: %s", command)
+    env = command_env(pool_id, res_id, res_name, id_in_pool, data)
+    config = app.config
+
+    if log:
+        ldir = _hooks_logdir(config['logdir'])
+        lfile = os.path.join(ldir, '{0:06d}_{1}'.format(res_id, ltype))
+        logfile_context = open(lfile, 'a+b')
+    else:
+        logfile_context = _no_logfile()
+
+    with logfile_context as logfile:
+        output = logfile or subprocess.DEVNULL
+        try:
+            sp = _spawn_command(
+                command, env=env, stderr=output,
+                stdout=subprocess.PIPE if catch_stdout_bytes else output,
+            )
+        except OSError as err:
+            app.log.error("Can't execute %s: %s", command, err)
+            if logfile:
+                logfile.write("Can't execute {0}: {1}\n".format(command, err)
+                              .encode("utf-8"))
+            # same as shell reports for non-existing commands
+            result = {'status': 127}
+            if catch_stdout_bytes:
+                result['stdout'] = b""
+            return result
+
+        if not catch_stdout_bytes:
+            return {'status': sp.wait()}
+
+        captured = _capture_lines(_stdout_chunks(sp, logfile),
+                                  catch_stdout_bytes,
+                                  catch_stdout_lines_securely)
 
     return {
         'status': sp.wait(),
-        'stdout': captured_string,
+        'stdout': captured,
     }
 
 
+# The last reload_config() result, pools.yaml is only re-parsed when changed.
+CONFIG_CACHE = {}
+CONFIG_CACHE_LOCK = threading.Lock()
+
+
 def reload_config():
+    """
+    Return {pool_id: Pool()} dict according to pools.yaml.  The Pool objects
+    are shared among threads (and re-used until the file is modified), so
+    they must be treated as read-only.
+    """
     config_dir = app.config["config_dir"]
     config_file = os.path.join(config_dir, "pools.yaml")
+    stat = os.stat(config_file)
+    cache_key = (config_file, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    with CONFIG_CACHE_LOCK:
+        if CONFIG_CACHE.get("key") == cache_key:
+            return dict(CONFIG_CACHE["pools"])
+
     config = helpers.load_config_file(config_file)
 
     pools = {}
@@ -124,79 +299,107 @@ def reload_config():
         pool.validate()
         pools[pool_id] = pool
 
-    return pools
+    with CONFIG_CACHE_LOCK:
+        CONFIG_CACHE["key"] = cache_key
+        CONFIG_CACHE["pools"] = pools
 
+    return dict(pools)
 
-class ThreadLocalData(threading.local):
-    """
-    Object of threading.local is always empty right after t.start() is called.
-    But if we define __init__() here, the method is always called appropriately
-    for each thread (so we have a convenient way to initialize thread-local
-    data).
 
-    This trick is described in/taken from  `_threading_local.py` (cpython).
-    """
-    def __init__(self, **kw):
-        self.__dict__.update(kw)
-        super(ThreadLocalData, self).__init__()
+# Per-pool thread pools executing the Worker jobs, {pool_id: (size, executor)}.
+EXECUTORS = {}
+EXECUTORS_LOCK = threading.Lock()
 
 
-class Worker(threading.Thread):
-    def __init__(self, event, pool, res_id, name=None):
-        self.local = ThreadLocalData(
-            pool=pool,
-            resource_id=res_id,
-        )
+def submit_job(pool, function):
+    """
+    Submit FUNCTION into the ThreadPoolExecutor dedicated to POOL.  The
+    executor outlives the Pool object (reload_config() creates new ones in each
+    loop), and is only re-created when the 'max' option for the pool changes.
+    We submit while holding the lock so the executor can not be shut down by
+    a concurrent resize in the meantime.
+    """
+    max_workers = max(pool.max, 1) * 2
+    with EXECUTORS_LOCK:
+        size, executor = EXECUTORS.get(pool.id, (None, None))
+        if size != max_workers:
+            if executor:
+                # The already submitted jobs are still processed by the old
+                # executor, we must not leave the resources in "working"
+                # states.
+                executor.shutdown(wait=False)
+            executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix=pool.id)
+            EXECUTORS[pool.id] = (max_workers, executor)
+        return executor.submit(function)
+
+
+# What the workers need to know about the resource, captured by the code that
+# spawns the worker (so the worker doesn't need to query the DB).
+ResourceSnapshot = namedtuple("ResourceSnapshot",
+                              ["id", "name", "id_in_pool", "data"])
+
+
+def resource_snapshot(resource):
+    """ Create ResourceSnapshot from the models.Resource object """
+    return ResourceSnapshot(resource.id, resource.name, resource.id_in_pool,
+                            resource.data)
+
+
+class Worker(object):
+    def __init__(self, event, pool, resource, name=None):
+        res_id = resource.id if resource else None
+        self.pool = pool
+        self.resource = resource
+        self.resource_id = res_id
         if name is not None:
-            name = "{0}-{1}".format(name, res_id or pool)
+            name = "{0}-{1}".format(name, res_id or pool.id)
+        self.name = name
         self.event = event
-        threading.Thread.__init__(self, name=name)
+
+    def start(self):
+        """ Submit the job into the pool's executor (see submit_job()) """
+        return submit_job(self.pool, self.run)
 
     def job(self):
         """ The task to be done by background thread. """
         raise NotImplementedError
 
-    def __getattr__(self, attr):
-        return getattr(self.local, attr)
-
     def run(self):
         self.log = app.log.getChild("worker")
+        # The executor threads are re-used, name them after the current job
+        # so the log entries are still readable.
+        thread = threading.current_thread()
+        thread_name = thread.name
+        if self.name:
+            thread.name = self.name
         try:
             self.job()
         except:
             self.log.exception("Worker exception, pool=%s resource=%s",
-                               self.pool, self.resource_id)
+                               self.pool.id, self.resource_id)
             raise
+        finally:
+            thread.name = thread_name
 
 
 class TerminateWorker(Worker):
-    def __init__(self, event, pool, res_id):
-        super(TerminateWorker, self).__init__(event, pool, res_id, "Terminator")
+    def __init__(self, event, pool, resource):
+        super(TerminateWorker, self).__init__(event, pool, resource,
+                                              "Terminator")
 
     def close(self):
         with session_scope() as session:
-            resource = session.query(models.Resource).get(self.resource_id)
-            resource.state = RState.ENDED
-            session.add(resource)
-            if resource.id_in_pool_object:
-                session.delete(resource.id_in_pool_object)
+            session.query(models.Resource)\
+                   .filter_by(id=self.resource_id)\
+                   .update({'state': RState.ENDED})
+            session.query(models.IDWithinPool)\
+                   .filter_by(resource_id=self.resource_id)\
+                   .delete()
         self.event.set()
 
     def job(self):
-        id_in_pool = None
-        with session_scope() as session:
-            resource = session.query(models.Resource).get(self.resource_id)
-            if resource.ticket:
-                if resource.ticket.state == helpers.TState.OPEN:
-                    self.log.warning("can't delete {0}, ticket opened"\
-                                     .format(resource.name))
-                    return
-            resource.state = RState.DELETING
-            session.add(resource)
-            session.flush()
-            id_in_pool = resource.id_in_pool
-            session.expunge(resource)
-
+        resource = self.resource
         self.log.info("Terminating %s started", resource.name)
         if not self.pool.cmd_delete:
             self.close()
@@ -206,7 +409,7 @@ class TerminateWorker(Worker):
                 self.pool.id,
                 resource.id,
                 resource.name,
-                id_in_pool,
+                resource.id_in_pool,
                 self.pool.cmd_delete,
                 'terminate',
                 data=resource.data,
@@ -216,32 +419,32 @@ class TerminateWorker(Worker):
 
 
 class ReleaseWorker(Worker):
-    def __init__(self, event, pool, res_id):
-        super(ReleaseWorker, self).__init__(event, pool, res_id, "Releaser")
+    def __init__(self, event, pool, resource):
+        super(ReleaseWorker, self).__init__(event, pool, resource, "Releaser")
 
     """ Call `Pool.cmd_release` shell command asynchronously """
     def job(self):
-        with session_scope() as session:
-            resource = session.query(models.Resource).get(self.resource_id)
-            id_in_pool = resource.id_in_pool
-            resource_name = resource.name
-            session.expunge(resource)
+        resource = self.resource
+        resource_name = resource.name
 
         self.log.info("Releasing %s", resource_name)
-        out = run_command(self.pool.id, resource.id, resource_name, id_in_pool,
-                          self.pool.cmd_release, "release", data=resource.data)
+        out = run_command(self.pool.id, resource.id, resource_name,
+                          resource.id_in_pool, self.pool.cmd_release,
+                          "release", data=resource.data)
         status = out["status"]
 
+        values = {'state': RState.UP}
+        if status:
+            self.log.error("Releasing worker failed: pool=%s name=%s cmd=%s",
+                           self.pool.name, resource_name,
+                           self.pool.cmd_release)
+            # mark it for removal
+            values['releases_counter'] = self.pool.reuse_max_count + 1
+
         with session_scope() as session:
-            # re-query the expunged resource
-            mod_resource = session.query(models.Resource).get(self.resource_id)
-            if status:
-                self.log.error("Releasing worker failed: pool=%s name=%s cmd=%s",
-                               self.pool.name, resource_name,
-                               self.pool.cmd_release)
-                # mark it for removal
-                mod_resource.releases_counter = self.pool.reuse_max_count + 1
-            mod_resource.state = RState.UP
+            session.query(models.Resource)\
+                   .filter_by(id=self.resource_id)\
+                   .update(values)
 
         if not status:
             self.event.set()
@@ -250,19 +453,15 @@ class ReleaseWorker(Worker):
 
 
 class AllocWorker(Worker):
-    def __init__(self, event, pool, res_id, name=None):
-        super(AllocWorker, self).__init__(event, pool, res_id, "Allocator")
+    def __init__(self, event, pool, resource, watcher_event=None):
+        super(AllocWorker, self).__init__(event, pool, resource, "Allocator")
+        self.watcher_event = watcher_event
 
     def job(self):
-        id_in_pool = None
-        with session_scope() as session:
-            resource = session.query(models.Resource).get(self.resource_id)
-            id_in_pool = resource.id_in_pool
-            session.expunge(resource)
-
+        resource = self.resource
         self.log.info(
             "Allocating %s (#%s in pool '%s') TID=%s",
-            resource.name, id_in_pool, self.pool.name,
+            resource.name, resource.id_in_pool, self.pool.name,
             threading.current_thread().ident
         )
 
@@ -271,14 +470,16 @@ class AllocWorker(Worker):
             self.pool.id,
             resource.id,
             resource.name,
-            id_in_pool,
+            resource.id_in_pool,
             self.pool.cmd_new,
             catch_stdout_bytes=512,
         )
 
         with session_scope() as session:
-            resource.state = RState.ENDED if output['status'] else RState.UP
-            resource.data = output['stdout']
+            state = RState.ENDED if output['status'] else RState.UP
+            session.query(models.Resource)\
+                   .filter_by(id=self.resource_id)\
+                   .update({'state': state, 'data': output['stdout']})
             tags = []
             if not isinstance(self.pool.tags, list):
                 msg = "Pool {pool} has set 'tags' set, but that's not an array"\
@@ -304,15 +505,20 @@ class AllocWorker(Worker):
                     tags.append(tag_obj)
 
             self.log.info("Allocating %s finished => %s",
-                          resource.name, resource.state)
-            session.add_all(tags + [resource])
+                          resource.name, state)
+            session.add_all(tags)
 
-            if resource.state == RState.ENDED:
-                session.delete(resource.id_in_pool_object)
+            if state == RState.ENDED:
+                session.query(models.IDWithinPool)\
+                       .filter_by(resource_id=self.resource_id)\
+                       .delete()
 
 
         # Notify manager that it is worth doing re-spin.
         self.event.set()
+        # The new resource needs to be checked by watcher.
+        if self.watcher_event and not output['status']:
+            self.watcher_event.set()
 
 
 class CleanUnknownWorker(Worker):
@@ -320,8 +526,8 @@ class CleanUnknownWorker(Worker):
     Delete all resources that are not recognized by resalloc
     https://github.com/praiskup/resalloc/issues/88
     """
-    def __init__(self, event, pool, res_id, name=None):
-        super(CleanUnknownWorker, self).__init__(event, pool, res_id,
+    def __init__(self, event, pool, resource=None):
+        super(CleanUnknownWorker, self).__init__(event, pool, resource,
                                                  "GarbageCleaner")
 
     def job(self):
@@ -371,10 +577,48 @@ class CleanUnknownWorker(Worker):
             return [resource.name for resource in on]
 
 
+class LivecheckWorker(Worker):
+    """ Call `Pool.cmd_livecheck` against one UP resource """
+    def __init__(self, event, pool, resource):
+        super(LivecheckWorker, self).__init__(event, pool, resource, "Watcher")
+
+    def job(self):
+        rc = run_command(
+                self.pool.id,
+                self.resource.id,
+                self.resource.name,
+                self.resource.id_in_pool,
+                self.pool.cmd_livecheck,
+                'watch',
+                data=self.resource.data,
+                log=self.pool.log_livecheck,
+        )
+
+        with session_scope() as session:
+            res = session.query(models.Resource).get(self.resource_id)
+            res.check_last_time = time.time()
+            if rc['status']:
+                res.check_failed_count = res.check_failed_count + 1
+                self.log.info("Check %s fail count %d", self.resource_id,
+                              res.check_failed_count)
+            else:
+                res.check_failed_count = 0
+            session.add(res)
+            session.flush()
+
+
 class Watcher(threading.Thread):
     def loop(self):
+        """
+        Check the resources that need it, and return the number of seconds
+        to wait before the next check is needed.
+        """
         app.log.info("Watcher loop")
         pools = reload_config()
+
+        periods = [p.livecheck_period for p in pools.values() if p.cmd_livecheck]
+        next_check = time.time() + min(periods, default=Pool.livecheck_period)
+
         to_check = {}
         with session_scope() as session:
             # Even though we never terminate resources that have assigned
@@ -386,48 +630,40 @@ class Watcher(threading.Thread):
                 if not item.pool in pools:
                     continue
                 to_check[item.id] = {
-                    'name': item.name,
+                    'resource': resource_snapshot(item),
                     'pool': item.pool,
                     'last': item.check_last_time,
                     'fail': item.check_failed_count,
-                    'id_in_pool': item.id_in_pool,
-                    'data': item.data,
                 }
 
-        for res_id, data in to_check.items():
+        # The checks are executed concurrently (in the pool executors), but we
+        # wait for all of them so the next loop doesn't re-submit them.
+        futures = []
+        for data in to_check.values():
             pool = pools[data['pool']]
             if not pool.cmd_livecheck:
                 continue
             if data['last'] + pool.livecheck_period > time.time():
                 # Not yet needed check.
+                next_check = min(next_check,
+                                 data['last'] + pool.livecheck_period)
                 continue
 
-            rc = run_command(
-                    pool.id,
-                    res_id,
-                    data['name'],
-                    data['id_in_pool'],
-                    pool.cmd_livecheck,
-                    'watch',
-                    data=data["data"],
-            )
+            worker = LivecheckWorker(self.event, pool, data['resource'])
+            futures.append(worker.start())
 
-            with session_scope() as session:
-                res = session.query(models.Resource).get(res_id)
-                res.check_last_time = time.time()
-                if rc['status']:
-                    res.check_failed_count = res.check_failed_count + 1
-                    app.log.info("Check %s fail count %d", res_id,
-                                 res.check_failed_count)
-                else:
-                    res.check_failed_count = 0
-                session.add(res)
-                session.flush()
+        for future in futures:
+            future.result()
+
+        # Never spin, even with livecheck_period=0.
+        return max(next_check - time.time(), 1)
 
     def run(self):
         while True:
-            self.loop()
-            time.sleep(app.config["sleeptime"] / 2)
+            timeout = self.loop()
+            # Sleep till the next check is needed, or till a new resource is
+            # allocated.
+            self.wakeup.wait(timeout=timeout)
 
 
 class Pool(object):
@@ -445,6 +681,7 @@ class Pool(object):
     cmd_release = None
     cmd_list = None
     livecheck_period = 600
+    log_livecheck = True
     tags = None
     name_pattern = "{pool_name}_{id}_{datetime}"
 
@@ -458,12 +695,13 @@ class Pool(object):
         self.name = id
 
 
-    def loop(self, event):
+    def loop(self, sync):
         """
         Perform one Pool iteration across all the corresponding instances,
-        and adjust the resource/ticket states.  ``event`` is the
-        ``Synchronizer().ticket`` object.
+        and adjust the resource/ticket states.  ``sync`` is the
+        ``Synchronizer()`` object.
         """
+        event = sync.ticket
 
         # decouple ticket from resource, and maybe switch UP → RELEASING
         self._detect_closed_tickets(event)
@@ -474,7 +712,7 @@ class Pool(object):
         # switch DELETE_REQUEST → ENDED
         self._garbage_collector(event)
 
-        self._allocate_more_resources(event)
+        self._allocate_more_resources(sync)
 
         # Delete all resources that are not recognized by resalloc
         self._clean_unknown_resources(event)
@@ -483,32 +721,41 @@ class Pool(object):
     def validate(self):
         assert(self.cmd_new)
         assert(self.cmd_delete)
+        for command in [self.cmd_new, self.cmd_delete, self.cmd_livecheck,
+                        self.cmd_release, self.cmd_list]:
+            # shell commands only
+            assert(command is None or isinstance(command, str))
 
 
     def _allocate_pool_id(self, session, resource):
         # allocate the lowest available pool_id
-        ids_query = (
-                session.query(models.IDWithinPool)
-                       .filter_by(pool_name=self.name)
-                       .order_by(models.IDWithinPool.id)
-        )
-        ids = {x.id: True for x in ids_query.all()}
-
-        found_id = None
-        try_id = 0
-        while True:
-            if try_id in ids:
-                try_id += 1
-                continue
+        ids = models.IDWithinPool
+        next_ids = aliased(models.IDWithinPool)
+
+        zero_taken = session.query(
+            session.query(ids).filter_by(pool_name=self.name, id=0).exists()
+        ).scalar()
+
+        found_id = 0
+        if zero_taken:
+            # the first ID not followed by ID+1 (at worst the maximum ID)
+            found_id = (
+                session.query(func.min(ids.id + 1))
+                .outerjoin(next_ids, and_(next_ids.pool_name == ids.pool_name,
+                                          next_ids.id == ids.id + 1))
+                .filter(ids.pool_name == self.name)
+                .filter(next_ids.id.is_(None))
+                .scalar()
+            )
 
-            found_id = models.IDWithinPool()
-            found_id.id = try_id
-            found_id.pool_name = self.name
-            found_id.resource_id = resource.id
-            return found_id
+        pool_id = models.IDWithinPool()
+        pool_id.id = found_id
+        pool_id.pool_name = self.name
+        pool_id.resource_id = resource.id
+        return pool_id
 
 
-    def allocate(self, event):
+    def allocate(self, sync):
         resource_id = None
         with session_scope() as session:
             dbinfo = session.query(models.Pool).get(self.name)
@@ -529,12 +776,13 @@ class Pool(object):
             resource.name = helpers.careful_string_format(
                     self.name_pattern, fill_dict)
             session.add(resource)
+            snapshot = ResourceSnapshot(int(resource_id), resource.name,
+                                        pool_id.id, None)
         if resource_id:
-            self.last_start = time.time()
-            AllocWorker(event, self, int(resource_id)).start()
+            AllocWorker(sync.ticket, self, snapshot, sync.watcher).start()
 
     def from_dict(self, data):
-        allowed_types = [int, str, dict, type(None)]
+        allowed_types = [int, str, dict, bool, type(None)]
 
         if type(data) != dict:
             # TODO: warning
@@ -572,17 +820,17 @@ class Pool(object):
             app.log.debug("Too soon for Pool('%s')", self.name)
         return is_too_soon
 
-    def _allocate_more_resources(self, event):
-        while True:
-            with session_scope() as session:
-                qres = QResources(session, pool=self.name)
-                stats = qres.stats()
+    def _allocate_more_resources(self, sync):
+        with session_scope() as session:
+            qres = QResources(session, pool=self.name)
+            stats = qres.stats()
 
-            msg = "=> POOL('{0}'):".format(self.name)
-            for key, val in stats.items():
-                msg = msg + ' {0}={1}'.format(key,val)
-            app.log.debug(msg)
+        msg = "=> POOL('{0}'):".format(self.name)
+        for key, val in stats.items():
+            msg = msg + ' {0}={1}'.format(key,val)
+        app.log.debug(msg)
 
+        while True:
             if stats['on'] >= self.max \
                    or stats['free'] + stats['start'] >= self.max_prealloc \
                    or stats['start'] >= self.max_starting \
@@ -590,7 +838,14 @@ class Pool(object):
                 # Quota reached, don't allocate more.
                 break
 
-            self.allocate(event)
+            self.allocate(sync)
+
+            # No need to re-query the stats, we know what changed.  The
+            # concurrently running workers may only make the checked numbers
+            # lower (STARTING → UP just moves the resource from 'start' to
+            # 'free').
+            stats['on'] += 1
+            stats['start'] += 1
 
     def _clean_unknown_resources(self, event):
         if not self.cmd_list:
@@ -609,7 +864,7 @@ class Pool(object):
         if minutes < 30:
             return
 
-        worker = CleanUnknownWorker(event, self, res_id=None)
+        worker = CleanUnknownWorker(event, self)
         worker.start()
 
         with session_scope() as session:
@@ -621,77 +876,102 @@ class Pool(object):
 
         with session_scope() as session:
             qres = QResources(session, pool=self.name)
-
-            for resource in qres.taken():
-                ticket = resource.ticket
-                assert ticket
-                if ticket.state == helpers.TState.CLOSED:
-                    release_resource(ticket)
-                    if self.cmd_release:
-                        # UP → RELEASING → UP, TODO: we might want to optimize
-                        # this a bit, and stop calling the releasing script when
-                        # the resource is not releasable anymore (max_reuses
-                        # reached, etc.).
-                        resource.state = helpers.RState.RELEASING
-                        close_resources.append(int(resource.id))
+            released = [ResourceSnapshot(*row) for row in qres.closed_tickets()]
+            if not released:
+                return
+
+            # UP → RELEASING → UP, TODO: we might want to optimize this a bit,
+            # and stop calling the releasing script when the resource is not
+            # releasable anymore (max_reuses reached, etc.).
+            state = helpers.RState.RELEASING if self.cmd_release else None
+            qres.release([res.id for res in released], state=state)
+            if self.cmd_release:
+                close_resources = released
 
         # We need to call this after the session_scope() above, because the
         # ReleaseWorker itself modifies the Resource records in DB concurrently.
         # Relates:
         # https://pagure.io/copr/copr/issue/2083
         # https://github.com/praiskup/resalloc/pull/87
-        for resource_id in close_resources:
-            ReleaseWorker(event, self, resource_id).start()
+        for resource in close_resources:
+            ReleaseWorker(event, self, resource).start()
 
     def _request_resource_removal(self):
+        # {(log level, reason): [resource names]}
+        removals = defaultdict(list)
+        remove_ids = set()
+
+        def _remove(res, reason, level=logging.DEBUG):
+            if res.id not in remove_ids:
+                remove_ids.add(res.id)
+                removals[(level, reason)].append(res.name)
+
+        columns = (
+            models.Resource.id,
+            models.Resource.name,
+            models.Resource.check_failed_count,
+            models.Resource.released_at,
+            models.Resource.sandboxed_since,
+            models.Resource.releases_counter,
+        )
+
         with session_scope() as session:
             now = time.time()
             qres = QResources(session, pool=self.name)
 
-            for res in qres.check_failure_candidates():
+            for res in qres.check_failure_candidates().with_entities(*columns):
                 if res.check_failed_count >= 3:
-                    app.log.warning(
-                        "Requesting %s removal for continuous failures",
-                        res.name)
-                    res.state = RState.DELETE_REQUEST
+                    _remove(res, "continuous failures", logging.WARNING)
                     continue
 
-            for res in qres.clean_candidates():
+            for res in qres.clean_candidates().with_entities(*columns):
                 if not self.reuse_opportunity_time:
                     # reuse turned off by default, remove no matter what
-                    app.log.debug("Removing %s, not reusable", res.name)
-                    res.state = RState.DELETE_REQUEST
+                    _remove(res, "not reusable")
                     continue
 
                 if res.released_at < (now - self.reuse_opportunity_time):
-                    app.log.debug("Removing %s, not taken quickly enough", res.name)
-                    res.state = RState.DELETE_REQUEST
+                    _remove(res, "not taken quickly enough")
                     continue
 
                 if self.reuse_max_time:
                     last_allowed = now - self.reuse_max_time
                     if res.sandboxed_since < last_allowed:
-                        app.log.debug(
-                            "Requesting %s removal, too long in one sandbox, "
-                            "since %s, last_allowed_time was %s, now %s",
-                            res.name, res.sandboxed_since, last_allowed, now)
-                        res.state = RState.DELETE_REQUEST
+                        _remove(res, "too long in one sandbox, max_time={0}"
+                                .format(self.reuse_max_time))
                         continue
 
                 if self.reuse_max_count and \
                         res.releases_counter > self.reuse_max_count:
-                    app.log.debug(
-                        "Requesting %s removal, max_reuses=%d reached",
-                        res.name, self.reuse_max_time)
-                    res.state = RState.DELETE_REQUEST
+                    _remove(res, "max_reuses={0} reached"
+                            .format(self.reuse_max_count))
                     continue
 
+            if remove_ids:
+                qres.request_removal(remove_ids)
+
+        for (level, reason), names in removals.items():
+            app.log.log(level, "Requesting removal of %s, %s",
+                        ", ".join(names), reason)
+
     def _garbage_collector(self, event):
         to_terminate = []
         with session_scope() as session:
             qres = QResources(session, pool=self.name)
-            for res in qres.clean().all():
-                TerminateWorker(event, self, int(res.id)).start()
+            query = qres.clean().options(
+                selectinload(models.Resource.id_in_pool_object))
+            for res in query:
+                if res.ticket and res.ticket.state == helpers.TState.OPEN:
+                    app.log.warning("can't delete %s, ticket opened", res.name)
+                    continue
+                # Switch the state before the worker is submitted, the job
+                # might wait in executor queue for some time and we don't
+                # want to submit it again in the next loop.
+                res.state = RState.DELETING
+                to_terminate.append(resource_snapshot(res))
+
+        for resource in to_terminate:
+            TerminateWorker(event, self, resource).start()
 
 
 class PrioritizedResource(PriorityQueueTask):
@@ -707,9 +987,94 @@ class PrioritizedResource(PriorityQueueTask):
         return self.resource.id
 
 
+ReadyResource = namedtuple("ReadyResource",
+                           ["id", "sandbox", "tags", "position"])
+
+
+class ReadyResources(object):
+    """
+    Index of resources ready to be assigned, built once per Manager loop.
+    Each resource has its own bit (by its position in the index), and for
+    each tag name we keep an integer bitmask of resources having that tag.
+    Finding the resources having all the ticket tags is then just a bitwise
+    AND of a few (arbitrarily long) integers.
+    """
+    def __init__(self, resources):
+        self.resources = []
+        self.positions = {}
+        self.by_tag = defaultdict(int)
+        # bitmask of resources not yet assigned
+        self.available = 0
+        for position, resource in enumerate(resources):
+            tags = {tag.id: tag.priority for tag in resource.tags}
+            self.resources.append(ReadyResource(
+                resource.id, resource.sandbox, tags, position))
+            self.positions[resource.id] = position
+            bit = 1 << position
+            self.available |= bit
+            for tag in tags:
+                self.by_tag[tag] |= bit
+
+    def __len__(self):
+        return bin(self.available).count("1")
+
+    def __bool__(self):
+        return bool(self.available)
+
+    def _candidates(self, ticket_tags):
+        """ Generate resources having all TICKET_TAGS (in index order) """
+        mask = self.available
+        for tag in ticket_tags:
+            mask &= self.by_tag.get(tag, 0)
+        while mask:
+            lowest = mask & -mask
+            yield self.resources[lowest.bit_length() - 1]
+            mask ^= lowest
+
+    def remove(self, res_id):
+        """ The resource is not ready anymore, drop it from index """
+        self.available &= ~(1 << self.positions[res_id])
+
+    def pop_best(self, ticket_tags, sandbox):
+        """
+        Find the best resource for the ticket having TICKET_TAGS and SANDBOX,
+        drop it from index and return its ID.  Return None if there's no
+        usable resource.
+        """
+        queue = PriorityQueue()
+        for resource in self._candidates(ticket_tags):
+            if resource.sandbox and resource.sandbox != sandbox:
+                continue
+
+            priority = 0
+            for tag in ticket_tags:
+                if resource.tags[tag] is not None:
+                    priority += resource.tags[tag]
+
+            if resource.sandbox:
+                # Re-used resources should be preferred to avoid allocating
+                # new and new resources for the same sandboxes.  TODO, make
+                # this configurable once needed.
+                priority += REUSED_RESOURCE_PRIORITY
+
+            queue.add_task(PrioritizedResource(resource), priority)
+
+        try:
+            res_id = queue.pop_task().resource.id
+        except KeyError:
+            return None
+
+        self.remove(res_id)
+        return res_id
+
+
 class Manager(object):
     def __init__(self, sync):
         self.sync = sync
+        # The pools are independent, so we can process them concurrently.
+        self.pool_executor = ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_POOL_LOOPS,
+            thread_name_prefix="Manager")
 
     def _notify_waiting(self, thread_id):
         self.sync.tid = thread_id
@@ -719,46 +1084,45 @@ class Manager(object):
     def _assign_tickets(self):
         with session_scope() as session:
             qticket = QTickets(session)
-            tickets = [x.id for x in qticket.waiting().order_by(models.Ticket.id).all()]
+            # Ticket tags never change, load them all at once.
+            tickets = [
+                (x.id, frozenset(x.tag_set)) for x in
+                qticket.waiting()
+                .options(selectinload(models.Ticket.tags))
+                .order_by(models.Ticket.id)
+            ]
+            if not tickets:
+                return
+
+            ready = ReadyResources(
+                QResources(session).ready()
+                .options(selectinload(models.Resource.tags))
+                .order_by(models.Resource.id)
+            )
+
+        for index, (ticket_id, ticket_tags) in enumerate(tickets):
+            if not ready:
+                app.log.debug("No available resource, skipping %d tickets",
+                              len(tickets) - index)
+                break
 
-        for ticket_id in tickets:
             notify_ticket = False
             with session_scope() as session:
                 ticket = session.query(models.Ticket).get(ticket_id)
                 qres = QResources(session)
-                resources = qres.ready().all()
 
-                if not resources:
-                    app.log.debug("No available resource, skipping %s", ticket)
-                    continue
-
-                queue = PriorityQueue()
-                ticket_tags = ticket.tag_set
-                for resource in resources:
-                    res_tags = resource.tag_set
-                    if resource.sandbox and resource.sandbox != ticket.sandbox:
-                        continue
-                    if not ticket_tags.issubset(res_tags):
-                        continue
+                resource = None
+                while not resource:
+                    resource_id = ready.pop_best(ticket_tags, ticket.sandbox)
+                    if resource_id is None:
+                        break
+                    # the resource might have changed since the index was built
+                    resource = qres.ready().filter(
+                        models.Resource.id == resource_id).first()
 
-                    priority = 0
-                    for tag in resource.tags:
-                        if tag.priority is not None and tag.id in ticket_tags:
-                            priority += tag.priority
-
-                    if resource.sandbox:
-                        # Re-used resources should be preferred to avoid
-                        # allocating new and new resources for the same
-                        # sandboxes.  TODO, make this configurable once needed.
-                        priority += REUSED_RESOURCE_PRIORITY
-
-                    queue.add_task(resource, priority)
-
-                try:
-                    resource = queue.pop_task()
-                except KeyError:
+                if not resource:
                     app.log.debug("%d resources UP but unusable for %s",
-                                  len(resources), ticket)
+                                  len(ready), ticket)
                     continue
 
                 # we found an appropriate resource
@@ -776,8 +1140,13 @@ class Manager(object):
         app.log.info("Manager's loop.")
 
         # Cleanup the old resources.
-        for _, pool in reload_config().items():
-            pool.loop(self.sync.ticket)
+        pools = list(reload_config().values())
+        if len(pools) == 1:
+            pools[0].loop(self.sync)
+        else:
+            # Wait for all the pools, and re-raise exceptions (if any).
+            list(self.pool_executor.map(lambda pool: pool.loop(self.sync),
+                                        pools))
 
         # Assign tasks.  This needs to be done after _detect_closed_tickets(),
         # because that call potentially releases some resources which need be
@@ -790,6 +1159,7 @@ class Manager(object):
 
         watcher = Watcher(name="Watcher")
         watcher.event = self.sync.ticket
+        watcher.wakeup = self.sync.watcher
         watcher.daemon = True
         watcher.start()
 
@@ -28,7 +28,7 @@ Base = declarative_base()
 class TagMixin(object):
     @property
     def tag_set(self):
-        return set(map(str, self.tags))
+        return {tag.id for tag in self.tags}
 
 class Serializer:
     def to_dict(self):
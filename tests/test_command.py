@@ -3,7 +3,11 @@
 import os
 import subprocess
 import tempfile
+import time
 
+import pytest
+
+from resallocserver.app import app
 from tests import mock
 
 # pylint: disable=missing-function-docstring, missing-class-docstring, attribute-defined-outside-init
@@ -29,11 +33,13 @@ logdir: {logdir}
             {"CONFIG_DIR": self.configdir},
         ))
         self.patchers[-1].start()
+        app.reset()
 
     def teardown_method(self, method):
         _unused = method
         for patcher in self.patchers:
             patcher.stop()
+        app.reset()
 
     def test_trim(self):
         """
@@ -62,3 +68,104 @@ logdir: {logdir}
         subprocess.check_call(["grep", "stderr", logfile])
         log_count_cmd = "wc -l < {}".format(logfile)
         assert subprocess.check_output(log_count_cmd, shell=True) == b'100001\n'
+
+    def test_daemonized_child(self):
+        """
+        The hook finished, but left a child process holding the stdout pipe.
+        Without os.pidfd_open() we can only read till EOF, so the quick return
+        is only guaranteed on Linux 5.3+ with Python 3.9+.
+        """
+        _unused = self
+
+        # pylint: disable=import-outside-toplevel
+        from resallocserver.manager import run_command
+
+        command = "echo first; echo second; sleep 3 & echo last"
+        start = time.time()
+        res = run_command("pool_daemon", 11, "res_11", 1, command,
+                          catch_stdout_bytes=100)
+        if hasattr(os, "pidfd_open"):
+            assert time.time() - start < 2
+        assert res["status"] == 0
+        assert res["stdout"] == b"first\nsecond\nlast\n"
+
+    def test_missing_executable(self):
+        _unused = self
+
+        # pylint: disable=import-outside-toplevel
+        from resallocserver.manager import run_command
+
+        command = "/non-existing-command arg"
+        res = run_command("pool_missing", 12, "res_12", 1, command)
+        assert res == {"status": 127}
+        res = run_command("pool_missing", 12, "res_12", 1, command,
+                          catch_stdout_bytes=100)
+        assert res == {"status": 127, "stdout": b""}
+
+        logfile = os.path.join(self.logdir, "hooks", "000012_alloc")
+        subprocess.check_call(["grep", "-q", "non-existing-command", logfile])
+
+    def test_no_shebang_script(self):
+        """
+        Executable script without the #! line, executed by shell.
+        """
+        # pylint: disable=import-outside-toplevel
+        from resallocserver.manager import run_command
+
+        script = os.path.join(self.workdir, "no-shebang")
+        with open(script, "w") as filed:
+            filed.write("echo hello-from-noshebang\n")
+        os.chmod(script, 0o755)
+
+        res = run_command("pool_script", 14, "res_14", 1, script,
+                          catch_stdout_bytes=100)
+        assert res == {"status": 0, "stdout": b"hello-from-noshebang\n"}
+        assert run_command("pool_script", 14, "res_14", 1, script) == \
+            {"status": 0}
+
+    def test_no_log(self):
+        _unused = self
+
+        # pylint: disable=import-outside-toplevel
+        from resallocserver.manager import run_command
+
+        res = run_command("pool_nolog", 13, "res_13", 1, "echo hello",
+                          ltype="watch", log=False)
+        assert res == {"status": 0}
+        res = run_command("pool_nolog", 13, "res_13", 1, "echo hello",
+                          ltype="watch", log=False, catch_stdout_bytes=100)
+        assert res == {"status": 0, "stdout": b"hello\n"}
+        assert not os.path.exists(
+            os.path.join(self.logdir, "hooks", "000013_watch"))
+
+
+@pytest.mark.parametrize("command, expected", [
+    ("/bin/true", ["/bin/true"]),
+    ("echo 'a b' c", ["echo", "a b", "c"]),
+    ("echo $HOME", None),
+    ("echo a | cat", None),
+    ("echo a > /dev/null", None),
+    ("FOO=bar env", None),
+    ("exit 1", None),
+    ("/non-existing-command", None),
+    ("echo 'unterminated", None),
+])
+def test_command_argv(command, expected):
+    # pylint: disable=import-outside-toplevel
+    from resallocserver.manager import command_argv
+    assert command_argv(command) == expected
+
+
+@pytest.mark.parametrize("chunks, securely, expected", [
+    ([b"a\nb", b"b\nc"], False, b"a\nbb\nc"),
+    ([b"a\nbb\n", b"ccc\n"], False, b"a\nbb\n<< trimmed >>\n"),
+    ([b"a\nbb\n", b"ccc\n"], True, b"a\nbb\n"),
+    ([b"aaaa", b"aaaa\nb\n"], False, b"aaaaaa<< trimmed >>\n"),
+    ([b"aaaa", b"aaaa\nb\n"], True, b""),
+    ([b"a\nbb", b"bbbbbbb"], False, b"a\n<< trimmed >>\n"),
+    ([], False, b""),
+])
+def test_capture_lines(chunks, securely, expected):
+    # pylint: disable=import-outside-toplevel
+    from resallocserver.manager import _capture_lines
+    assert _capture_lines(chunks, 6, securely) == expected
@@ -0,0 +1,16 @@
+""" Tests for resalloc/helpers.py """
+
+# pylint: disable=missing-function-docstring
+
+from resalloc.helpers import careful_string_format
+
+
+def test_careful_string_format():
+    fill_dict = {"id": "00000010", "pool_name": "pool"}
+    result = careful_string_format("{pool_name}_{id}_{datetime}", fill_dict)
+    assert result == "pool_00000010_" + fill_dict["datetime"]
+
+
+def test_careful_string_format_unknown():
+    result = careful_string_format("{pool_name}_{unknown}", {"pool_name": "x"})
+    assert result == "x_{unknown}"
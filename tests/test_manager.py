@@ -4,7 +4,10 @@ Tests for resallocserver/manager.py
 
 # pylint: disable=protected-access
 
+import os
 import random
+import threading
+import time
 
 import pytest
 
@@ -12,9 +15,16 @@ from resalloc.helpers import TState
 from resallocserver import models
 from resallocserver.app import session_scope
 from resallocserver.main import Synchronizer
-from resallocserver.manager import Manager
+from resallocserver.manager import (
+    EXECUTORS,
+    Manager,
+    Pool,
+    Watcher,
+    reload_config,
+    submit_job,
+)
 
-from tests import ResallocTestCase
+from tests import ResallocTestCase, mock
 
 
 class TestManager(ResallocTestCase):
@@ -78,3 +88,226 @@ class TestManager(ResallocTestCase):
         with session_scope() as session:
             ticket = session.query(models.Ticket).get(1)
             assert ticket.resource.name == expected_car
+
+    def test_reload_config_cache(self):
+        pools_file = os.path.join(self.workdir, "etc", "pools.yaml")
+        with open(pools_file, "w") as fd:
+            fd.write("pool1:\n  cmd_new: /bin/true\n  cmd_delete: /bin/true\n")
+
+        pools = reload_config()
+        assert list(pools) == ["pool1"]
+        assert reload_config()["pool1"] is pools["pool1"]
+
+        with open(pools_file, "a") as fd:
+            fd.write("pool2:\n  cmd_new: /bin/true\n  cmd_delete: /bin/true\n")
+
+        new_pools = reload_config()
+        assert list(new_pools) == ["pool1", "pool2"]
+        assert new_pools["pool1"] is not pools["pool1"]
+
+    @pytest.mark.parametrize(
+        "taken_ids, expected_id", [
+        ([], 0),
+        ([0, 1, 2], 3),
+        ([0, 1, 3, 4], 2),
+        ([1, 2], 0),
+        ([0, 2, 3, 5], 1),
+    ])
+    def test_allocate_pool_id(self, taken_ids, expected_id):
+        self.prepare_database({
+            "pools": {"pool": {}, "other": {}},
+            "resources": {
+                "res{}".format(i): {"pool": "pool", "data": b"x"}
+                for i in range(10)
+            },
+        })
+        with session_scope() as session:
+            for res_id, id_in_pool in enumerate(taken_ids, start=1):
+                session.add(models.IDWithinPool(
+                    resource_id=res_id,
+                    pool_name="pool",
+                    id=id_in_pool,
+                ))
+            # IDs taken in a different pool don't matter
+            session.add(models.IDWithinPool(resource_id=10, pool_name="other",
+                                            id=expected_id))
+
+        pool = Pool("pool")
+        with session_scope() as session:
+            resource = session.query(models.Resource).get(9)
+            assert pool._allocate_pool_id(session, resource).id == expected_id
+
+    def test_assign_more_tickets(self):
+        self.prepare_database({
+            "resources": {
+                "res1": {"data": b"1", "tags": {"A": {}, "B": {}}},
+                "res2": {"data": b"2", "tags": {"A": {"priority": 1}}},
+                "res3": {"data": b"3", "tags": {"C": {}}},
+            },
+        })
+
+        with session_scope() as session:
+            for tags in [["A"], ["A"], ["A"], ["C"]]:
+                ticket = models.Ticket(state=TState.OPEN)
+                session.add(ticket)
+                for tag in tags:
+                    session.add(models.TicketTag(ticket=ticket, id=tag))
+
+        manager = Manager(Synchronizer())
+        manager._assign_tickets()
+
+        with session_scope() as session:
+            assigned = {
+                ticket.id: ticket.resource.name if ticket.resource else None
+                for ticket in session.query(models.Ticket).all()
+            }
+            assert assigned == {1: "res2", 2: "res1", 3: None, 4: "res3"}
+
+    def test_detect_closed_tickets(self):
+        self.prepare_database({
+            "resources": {
+                "res1": {"data": b"1", "pool": "pool"},
+                "res2": {"data": b"2", "pool": "pool"},
+                "res3": {"data": b"3", "pool": "other"},
+            },
+        })
+        with session_scope() as session:
+            for res_id, state in [(1, TState.CLOSED), (2, TState.OPEN),
+                                  (3, TState.CLOSED)]:
+                ticket = models.Ticket(state=state, resource_id=res_id)
+                session.add(ticket)
+                session.flush()
+                session.query(models.Resource).get(res_id).ticket_id = ticket.id
+
+        Pool("pool")._detect_closed_tickets(Synchronizer().ticket)
+
+        with session_scope() as session:
+            resources = session.query(models.Resource).order_by(
+                models.Resource.id).all()
+            assert [r.ticket_id for r in resources] == [None, 2, 3]
+            assert [r.releases_counter for r in resources] == [1, 0, 0]
+            assert resources[0].released_at
+            assert [r.state for r in resources] == ["UP"] * 3
+
+    def test_request_resource_removal(self):
+        self.prepare_database({
+            "resources": {
+                "failing": {"data": b"1", "pool": "pool"},
+                "released": {"data": b"2", "pool": "pool"},
+                "fresh": {"data": b"3", "pool": "pool"},
+                "other": {"data": b"4", "pool": "other"},
+            },
+        })
+        with session_scope() as session:
+            resources = session.query(models.Resource).order_by(
+                models.Resource.id).all()
+            resources[0].check_failed_count = 3
+            for resource in resources[1], resources[3]:
+                resource.released_at = 1
+                resource.sandboxed_since = 1
+
+        Pool("pool")._request_resource_removal()
+
+        with session_scope() as session:
+            states = {r.name: r.state for r in session.query(models.Resource)}
+            assert states == {
+                "failing": "DELETE_REQUEST",
+                "released": "DELETE_REQUEST",
+                "fresh": "UP",
+                "other": "UP",
+            }
+
+    @pytest.mark.parametrize(
+        "check_ago, min_timeout, max_timeout", [
+        # only the due resource, the next check is after livecheck_period
+        (None, 99, 100),
+        # the other resource needs to be checked in 70s
+        (30, 69, 70),
+        # never spin, at least 1s
+        (99.5, 1, 1),
+    ])
+    def test_watcher_timeout(self, check_ago, min_timeout, max_timeout):
+        pools_file = os.path.join(self.workdir, "etc", "pools.yaml")
+        with open(pools_file, "w") as fd:
+            fd.write("pool:\n"
+                     "  cmd_new: /bin/true\n"
+                     "  cmd_delete: /bin/true\n"
+                     "  cmd_livecheck: /bin/true\n"
+                     "  livecheck_period: 100\n")
+
+        resources = {"due": {"data": b"1", "pool": "pool"}}
+        if check_ago is not None:
+            resources["not_due"] = {"data": b"2", "pool": "pool"}
+        self.prepare_database({"pools": {"pool": {}}, "resources": resources})
+
+        now = time.time()
+        with session_scope() as session:
+            for resource in session.query(models.Resource):
+                resource.check_last_time = 0
+                if resource.name == "not_due":
+                    resource.check_last_time = now - check_ago
+
+        watcher = Watcher()
+        watcher.event = Synchronizer().ticket
+        timeout = watcher.loop()
+        assert min_timeout <= timeout <= max_timeout
+
+        with session_scope() as session:
+            due = session.query(models.Resource).filter_by(name="due").one()
+            assert due.check_last_time >= now
+
+    def test_submit_job_resize(self):
+        pool = Pool("resized")
+        pool.max = 1
+        blocker = threading.Event()
+
+        def job(value):
+            blocker.wait(10)
+            return value
+
+        # two running jobs, and one waiting in the queue
+        futures = [submit_job(pool, lambda i=i: job(i)) for i in range(3)]
+        old_executor = EXECUTORS["resized"][1]
+
+        pool.max = 2
+        futures.append(submit_job(pool, lambda: job(3)))
+        assert EXECUTORS["resized"][0] == 4
+        assert EXECUTORS["resized"][1] is not old_executor
+        with pytest.raises(RuntimeError):
+            old_executor.submit(lambda: None)
+
+        blocker.set()
+        assert [f.result(timeout=10) for f in futures] == [0, 1, 2, 3]
+        EXECUTORS.pop("resized")[1].shutdown()
+
+    def test_manager_loop_more_pools(self):
+        pools_file = os.path.join(self.workdir, "etc", "pools.yaml")
+        with open(pools_file, "w") as fd:
+            for pool in ["pool1", "pool2"]:
+                fd.write(pool + ":\n"
+                         "  max: 1\n"
+                         "  max_prealloc: 1\n"
+                         "  cmd_new: echo data\n"
+                         "  cmd_delete: /bin/true\n")
+        self.prepare_database({"pools": {"pool1": {}, "pool2": {}}})
+
+        manager = Manager(Synchronizer())
+        manager._loop()
+        # wait for the AllocWorkers
+        for pool in ["pool1", "pool2"]:
+            EXECUTORS.pop(pool)[1].shutdown()
+
+        with session_scope() as session:
+            resources = session.query(models.Resource).all()
+            assert sorted(r.pool for r in resources) == ["pool1", "pool2"]
+
+        original_loop = Pool.loop
+
+        def failing_loop(pool, sync):
+            if pool.name == "pool2":
+                raise RuntimeError("pool2 failed")
+            return original_loop(pool, sync)
+
+        with mock.patch.object(Pool, "loop", failing_loop):
+            with pytest.raises(RuntimeError, match="pool2 failed"):
+                manager._loop()